@@ -1,16 +1,24 @@
+import argparse
 import asyncio
+import io
 import os
+import sys
+import threading
+import time
 import datetime as dt
-from typing import Dict, Optional, List
+from collections import Counter
+from typing import Dict, Optional, List, Tuple
 
 import aiosqlite
 from telegram import (
-    Update, InlineKeyboardButton, InlineKeyboardMarkup, User as TgUser
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, User as TgUser, Message, Bot,
+    InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio
 )
-from telegram.constants import ChatType
+from telegram.constants import ChatType, ChatMemberStatus
+from telegram.error import RetryAfter
 from telegram.ext import (
-    ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler,
-    CallbackQueryHandler, filters
+    Application, ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler,
+    CallbackQueryHandler, TypeHandler, ApplicationHandlerStop, filters
 )
 
 # ============ НАСТРОЙКИ ============
@@ -53,6 +61,30 @@ CAT_TITLES_RU = {
 # Активные «сессии ответа» модераторов: mod_id -> ticket_id
 active_reply: Dict[int, str] = {}
 
+# Антифлуд в личке: token bucket на пользователя (USER_RATE токенов/с, ёмкость USER_BURST)
+USER_RATE = float(os.getenv("USER_RATE", "1"))
+USER_BURST = float(os.getenv("USER_BURST", "5"))
+SLOWDOWN_NOTICE_INTERVAL = 30        # не чаще одного «помедленнее» на пользователя, с
+ABUSE_WINDOW = 60                    # окно подсчёта отброшенных апдейтов, с
+ABUSE_DROPS = 20                     # столько отбросов за окно — сигнал модераторам
+ABUSE_FLAG_COOLDOWN = 600            # повторный сигнал по тому же пользователю не раньше, с
+# Перегрузка: очередь апдейтов глубже порога — личка дороже, второстепенная работа отключается
+OVERLOAD_QUEUE_DEPTH = int(os.getenv("OVERLOAD_QUEUE_DEPTH", "100"))
+OVERLOAD_COST = 3.0
+OVERLOAD_NOTICE_COOLDOWN = 600       # повторное сообщение о перегрузке в группу не раньше, с
+# Альбом приходит отдельным апдейтом на каждый элемент: решение по первому применяется ко всем
+MEDIA_GROUP_TTL = 10.0
+flood_state: Dict[int, Dict[str, float]] = {}
+media_group_admit: Dict[str, Tuple[float, bool]] = {}  # media_group_id -> (время, пропущен ли)
+overload_mode = False
+overload_notice_at = float("-inf")
+
+# Профилирование: шаг сэмплера стека, шаг замера лага цикла, предел окна /profile
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+PROFILE_LAG_INTERVAL = float(os.getenv("PROFILE_LAG_INTERVAL", "0.1"))
+PROFILE_MAX_SECONDS = 300
+profile_lock = asyncio.Lock()
+
 # ============ СХЕМА БД ============
 INIT_SQL = """
 PRAGMA journal_mode=WAL;
@@ -92,6 +124,24 @@ CREATE TABLE IF NOT EXISTS settings (
   value TEXT
 );
 
+-- Медиафайлы, уже лежащие на серверах Telegram (дедуп по file_unique_id)
+CREATE TABLE IF NOT EXISTS media_files (
+  file_unique_id TEXT PRIMARY KEY,
+  file_id TEXT NOT NULL,                         -- последний известный file_id для повторной отправки
+  media_type TEXT NOT NULL                       -- photo|video|document|audio|voice|animation|video_note|sticker
+);
+
+-- Вложения сообщений тикета
+CREATE TABLE IF NOT EXISTS ticket_media (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  ticket_id TEXT NOT NULL,
+  message_id INTEGER,                            -- messages.id
+  from_role TEXT NOT NULL,                       -- 'user' | 'mod'
+  file_unique_id TEXT NOT NULL,
+  caption TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_ticket_media_ticket ON ticket_media(ticket_id);
+
 -- Автоответчики по категориям
 CREATE TABLE IF NOT EXISTS autoresponders (
   category TEXT PRIMARY KEY,                     -- tech|pay|hwid|coop|faq
@@ -205,15 +255,70 @@ async def get_ticket_header(ticket_id: str) -> Optional[int]:
         return int(r["group_header_msg_id"]) if r and r["group_header_msg_id"] is not None else None
 
 async def record_msg(ticket_id: str, role: str, text: str,
-                     user_msg_id: Optional[int], group_msg_id: Optional[int]) -> None:
+                     user_msg_id: Optional[int], group_msg_id: Optional[int],
+                     media: Optional[List[Tuple[str, str, str, Optional[str]]]] = None) -> None:
+    """
+    Логирует сообщение тикета. `media` — вложения (media_type, file_id, file_unique_id, caption),
+    пишутся в той же транзакции.
+    """
     async with aiosqlite.connect(DB_PATH) as conn:
-        await conn.execute(
+        cur = await conn.execute(
             "INSERT INTO messages(ticket_id,from_role,text,user_msg_id,group_msg_id,created_at) "
             "VALUES(?,?,?,?,?,?)",
             (ticket_id, role, text or "", user_msg_id, group_msg_id, dt.datetime.utcnow().isoformat())
         )
+        for media_type, file_id, file_unique_id, caption in media or []:
+            await conn.execute(
+                "INSERT INTO media_files(file_unique_id,file_id,media_type) VALUES(?,?,?) "
+                "ON CONFLICT(file_unique_id) DO UPDATE SET file_id=excluded.file_id",
+                (file_unique_id, file_id, media_type))
+            await conn.execute(
+                "INSERT INTO ticket_media(ticket_id,message_id,from_role,file_unique_id,caption) "
+                "VALUES(?,?,?,?,?)",
+                (ticket_id, cur.lastrowid, role, file_unique_id, caption))
         await conn.commit()
 
+def extract_media(msg: Message) -> Optional[Tuple[str, str, str]]:
+    """(media_type, file_id, file_unique_id) вложения сообщения или None."""
+    if msg.photo:
+        f = msg.photo[-1]  # самый крупный размер
+        return "photo", f.file_id, f.file_unique_id
+    # animation проверяем раньше document: у GIF заполнены оба поля
+    for kind in ("animation", "video", "document", "audio", "voice", "video_note", "sticker"):
+        f = getattr(msg, kind)
+        if f is not None:
+            return kind, f.file_id, f.file_unique_id
+    return None
+
+def media_label(text: str, media: Optional[Tuple]) -> str:
+    """Текст для истории с меткой вложения: «[photo] подпись»."""
+    return f"[{media[0]}] {text}".rstrip() if media else text
+
+async def record_msg_media(ticket_id: str, role: str, msg: Message,
+                           user_msg_id: Optional[int], group_msg_id: Optional[int]) -> None:
+    """Логирует сообщение; если есть вложение — сохраняет его file_id для истории."""
+    media = extract_media(msg)
+    text = media_label(msg.text or msg.caption or "", media) or "[media]"
+    await record_msg(ticket_id, role, text, user_msg_id, group_msg_id,
+                     media=[(*media, msg.caption)] if media else None)
+
+async def get_ticket_media(ticket_id: str, limit: int = 30) -> List[Tuple[str, str, Optional[str]]]:
+    """
+    (media_type, file_id, caption) вложений из последних `limit` сообщений тикета
+    (то же окно, что у ticket_history_text) по порядку, без повторов одного файла.
+    """
+    async with aiosqlite.connect(DB_PATH) as conn:
+        conn.row_factory = aiosqlite.Row
+        cur = await conn.execute(
+            "SELECT f.media_type, f.file_id, tm.caption, MIN(tm.id) AS first_id "
+            "FROM ticket_media tm JOIN media_files f ON f.file_unique_id = tm.file_unique_id "
+            "WHERE tm.ticket_id=? AND tm.message_id IN "
+            "(SELECT id FROM messages WHERE ticket_id=? ORDER BY id DESC LIMIT ?) "
+            "GROUP BY tm.file_unique_id ORDER BY first_id ASC",
+            (ticket_id, ticket_id, limit))
+        rows = await cur.fetchall()
+    return [(str(r["media_type"]), str(r["file_id"]), r["caption"]) for r in rows]
+
 async def get_ticket_group_msg_ids(ticket_id: str) -> List[int]:
     async with aiosqlite.connect(DB_PATH) as conn:
         conn.row_factory = aiosqlite.Row
@@ -266,6 +371,69 @@ async def ticket_history_text(ticket_id: str, limit: int = 30) -> str:
         parts.append(f"{role}:\n{txt}\n")
     return "\n".join(parts)
 
+# Типы, которые Telegram разрешает объединять в альбом, и с чем их можно смешивать
+ALBUM_KIND = {"photo": "visual", "video": "visual", "document": "document", "audio": "audio"}
+INPUT_MEDIA = {"photo": InputMediaPhoto, "video": InputMediaVideo,
+               "document": InputMediaDocument, "audio": InputMediaAudio}
+SINGLE_SEND = {"photo": "send_photo", "video": "send_video", "document": "send_document",
+               "audio": "send_audio", "animation": "send_animation", "voice": "send_voice",
+               "video_note": "send_video_note", "sticker": "send_sticker"}
+
+async def send_ticket_media(bot: Bot, chat_id: int, ticket_id: str, limit: int = 30,
+                            reply_to: Optional[int] = None) -> Tuple[int, int]:
+    """
+    Повторно отправляет вложения тикета по file_id (без загрузки файлов) альбомами по 2–10.
+    Возвращает (отправлено, всего).
+    """
+    items = await get_ticket_media(ticket_id, limit)
+    batch: List[Tuple[str, str, Optional[str]]] = []
+    batch_kind: Optional[str] = None
+    sent = 0
+
+    async def send_batch():
+        if len(batch) == 1:
+            media_type, file_id, caption = batch[0]
+            kwargs = {} if media_type in ("video_note", "sticker") else {"caption": caption}
+            await getattr(bot, SINGLE_SEND[media_type])(chat_id, file_id,
+                                                        reply_to_message_id=reply_to, **kwargs)
+        else:
+            await bot.send_media_group(
+                chat_id, reply_to_message_id=reply_to,
+                media=[INPUT_MEDIA[t](media=f, caption=c) for t, f, c in batch])
+
+    async def flush():
+        nonlocal batch, batch_kind, sent
+        for _ in range(3):
+            if not batch:
+                break
+            try:
+                await send_batch()
+                sent += len(batch)
+                await asyncio.sleep(0.03)
+            except RetryAfter as e:
+                # лимит группы ~20 сообщений/мин — ждём и повторяем этот же пакет
+                await asyncio.sleep(float(e.retry_after) + 0.5)
+                continue
+            except Exception:
+                pass
+            break
+        batch, batch_kind = [], None
+
+    for item in items:
+        kind = ALBUM_KIND.get(item[0])
+        if kind is None or kind != batch_kind or len(batch) == 10:
+            await flush()
+            batch_kind = kind
+        batch.append(item)
+        if kind is None:
+            await flush()
+    await flush()
+    return sent, len(items)
+
+async def report_unsent_media(message: Message, sent: int, total: int) -> None:
+    if sent < total:
+        await message.reply_text(f"⚠️ Не удалось отправить вложений: {total - sent} из {total}.")
+
 async def stats_text() -> str:
     async with aiosqlite.connect(DB_PATH) as conn:
         conn.row_factory = aiosqlite.Row
@@ -341,6 +509,81 @@ def autores_cat_keyboard(cat: str) -> InlineKeyboardMarkup:
         [InlineKeyboardButton("⬅️ Назад", callback_data="p:autores")],
     ])
 
+# ============ АНТИФЛУД ============
+def take_token(uid: int, now: float, cost: float) -> Tuple[bool, Dict[str, float]]:
+    st = flood_state.get(uid)
+    if st is None:
+        if len(flood_state) > 10000:
+            # выбрасываем тех, у кого ведро уже успело наполниться
+            full_after = USER_BURST / USER_RATE if USER_RATE > 0 else float("inf")
+            for k in [k for k, v in flood_state.items() if now - v["ts"] > full_after]:
+                del flood_state[k]
+        st = flood_state[uid] = {"tokens": USER_BURST, "ts": now, "drops": 0,
+                                 "drops_since": now, "notice_at": float("-inf"), "flag_at": float("-inf")}
+    st["tokens"] = min(USER_BURST, st["tokens"] + (now - st["ts"]) * USER_RATE)
+    st["ts"] = now
+    if st["tokens"] >= cost:
+        st["tokens"] -= cost
+        return True, st
+    return False, st
+
+async def admission_control(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Пропуск апдейтов из лички до всех остальных хендлеров (group=-1).
+    Лишнее отбрасывается до любых обращений к БД и Bot API.
+    """
+    global overload_mode, overload_notice_at
+    chat, user = update.effective_chat, update.effective_user
+    if chat is None or user is None or chat.type != ChatType.PRIVATE:
+        return
+
+    now = time.monotonic()
+    depth = context.application.update_queue.qsize()
+    if not overload_mode and depth >= OVERLOAD_QUEUE_DEPTH:
+        overload_mode = True
+        if now - overload_notice_at >= OVERLOAD_NOTICE_COOLDOWN:
+            overload_notice_at = now
+            context.application.create_task(context.bot.send_message(
+                MOD_GROUP_ID, f"🔥 Перегрузка: в очереди {depth} апдейтов, личка ограничена."))
+    elif overload_mode and depth < OVERLOAD_QUEUE_DEPTH // 2:
+        overload_mode = False
+
+    mg_id = update.message.media_group_id if update.message else None
+    if mg_id:
+        seen = media_group_admit.get(mg_id)
+        if seen and now - seen[0] <= MEDIA_GROUP_TTL:
+            if seen[1]:
+                return
+            raise ApplicationHandlerStop  # остаток отброшенного альбома в отбросы не считаем
+
+    ok, st = take_token(user.id, now, OVERLOAD_COST if overload_mode else 1.0)
+    if mg_id:
+        if len(media_group_admit) > 1000:
+            for k in [k for k, v in media_group_admit.items() if now - v[0] > MEDIA_GROUP_TTL]:
+                del media_group_admit[k]
+        media_group_admit[mg_id] = (now, ok)
+    if ok:
+        return
+
+    if now - st["drops_since"] > ABUSE_WINDOW:
+        st["drops"], st["drops_since"] = 0, now
+    st["drops"] += 1
+
+    if now - st["notice_at"] >= SLOWDOWN_NOTICE_INTERVAL:
+        st["notice_at"] = now
+        context.application.create_task(context.bot.send_message(
+            user.id, "⏳ Слишком много сообщений, подождите немного.\n"
+                     "Too many messages, please slow down."))
+    if st["drops"] >= ABUSE_DROPS and now - st["flag_at"] >= ABUSE_FLAG_COOLDOWN:
+        st["flag_at"] = now
+        context.application.create_task(context.bot.send_message(
+            MOD_GROUP_ID, f"⚠️ Флуд от @{user.username or user.full_name} (ID: {user.id}): "
+                          f"отброшено {int(st['drops'])} апдейтов за {ABUSE_WINDOW} с."))
+    if update.callback_query:
+        # иначе у клиента крутится спиннер, и пользователь жмёт кнопку снова
+        context.application.create_task(update.callback_query.answer())
+    raise ApplicationHandlerStop
+
 # ============ ПОЛЬЗОВАТЕЛЬ ============
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     kb = InlineKeyboardMarkup([
@@ -382,6 +625,9 @@ async def pm_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 1) Причина
     if stage == "reason":
         context.user_data["reason"] = text
+        # вложение причины сохраняем после создания тикета
+        media = extract_media(update.effective_message)
+        context.user_data["reason_media"] = (*media, update.effective_message.caption) if media else None
         context.user_data["stage"] = "description"
         t = "Опишите подробнее вашу проблему:" if lang == "ru" else "Please describe your problem in detail:"
         await update.effective_message.reply_text(t)
@@ -408,15 +654,22 @@ async def pm_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await store_group_header(t_id, hmsg.message_id)
         await record_msg(t_id, "system", header, None, hmsg.message_id)
 
-        # Автоответчик
-        if await autores_enabled():
+        # Автоответчик (при перегрузке пропускаем — это второстепенная работа)
+        if not overload_mode and await autores_enabled():
             atext = await get_autoresponder_text(cat)
             if atext:
                 await context.bot.send_message(chat_id=uid, text=atext)
 
         # Лог контента
-        await record_msg(t_id, "user", f"[Причина] {reason}\n[Описание] {description}",
-                         update.effective_message.message_id, None)
+        reason_media = context.user_data.get("reason_media")
+        media = extract_media(update.effective_message)
+        if media:
+            media = (*media, update.effective_message.caption)
+        await record_msg(t_id, "user",
+                         f"[Причина] {media_label(reason, reason_media)}\n"
+                         f"[Описание] {media_label(description, media)}",
+                         update.effective_message.message_id, None,
+                         media=[m for m in (reason_media, media) if m])
         context.user_data.clear()
         return
 
@@ -444,8 +697,8 @@ async def pm_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         from_chat_id=uid,
         message_id=update.effective_message.message_id
     )
-    await record_msg(t_id, "user", text or "[media]",
-                     update.effective_message.message_id, copied.message_id)
+    await record_msg_media(t_id, "user", update.effective_message,
+                           update.effective_message.message_id, copied.message_id)
 
 # ============ КНОПКИ ТИКЕТА (ГРУППА) ============
 async def cb_ticket_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -464,6 +717,9 @@ async def cb_ticket_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if action == "hist":
         txt = await ticket_history_text(ticket_id, limit=30)
         await q.message.reply_text(txt, reply_to_message_id=q.message.message_id)
+        sent, total = await send_ticket_media(context.bot, MOD_GROUP_ID, ticket_id, limit=30,
+                                              reply_to=q.message.message_id)
+        await report_unsent_media(q.message, sent, total)
         return
 
     if action == "take":
@@ -539,8 +795,8 @@ async def mod_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         from_chat_id=MOD_GROUP_ID,
         message_id=update.effective_message.message_id
     )
-    text = update.effective_message.text or update.effective_message.caption or "[media]"
-    await record_msg(ticket_id, "mod", text, None, update.effective_message.message_id)
+    await record_msg_media(ticket_id, "mod", update.effective_message,
+                           None, update.effective_message.message_id)
 
 async def cmd_end(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != MOD_GROUP_ID:
@@ -597,6 +853,14 @@ async def cb_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await q.message.edit_text(txt, reply_markup=stats_keyboard())
         return
 
+    if parts[1] == "history" and len(parts) == 4 and parts[2] == "show":
+        t_id = parts[3]
+        txt = await ticket_history_text(t_id, limit=30)
+        await q.message.reply_text(txt)
+        sent, total = await send_ticket_media(context.bot, MOD_GROUP_ID, t_id, limit=30)
+        await report_unsent_media(q.message, sent, total)
+        return
+
     if parts[1] == "history":
         ids = await last_tickets(limit=10)
         if not ids:
@@ -671,6 +935,8 @@ async def cmd_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     txt = await ticket_history_text(t_id, limit=50)
     await update.effective_message.reply_text(txt)
+    sent, total = await send_ticket_media(context.bot, MOD_GROUP_ID, t_id, limit=50)
+    await report_unsent_media(update.effective_message, sent, total)
 
 async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != MOD_GROUP_ID:
@@ -678,11 +944,255 @@ async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     txt = await stats_text()
     await update.effective_message.reply_text(txt)
 
+# ============ ПРОФИЛИРОВАНИЕ ============
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+def _sample_stacks(thread_id: int, interval: float, stop: threading.Event,
+                   stacks: Counter, samples: List[int]) -> None:
+    """
+    Фоновый поток: периодически снимает стек потока event loop'а (свёрнутый формат).
+    Сэмпл весит столько секунд, сколько прошло с предыдущего: пока цикл держит GIL,
+    поток просыпается реже, и при весе 1 занятое время занижалось бы.
+    """
+    prev = time.perf_counter()
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        now = time.perf_counter()
+        names: List[str] = []
+        while frame is not None:
+            names.append(_frame_name(frame))
+            frame = frame.f_back
+        if names:
+            stacks[";".join(reversed(names))] += now - prev
+            samples[0] += 1
+        prev = now
+
+async def _measure_lag(interval: float, lags: List[float]) -> None:
+    """Лаг цикла: насколько позже запланированного просыпается sleep(interval)."""
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - t0 - interval))
+
+def _task_coro_name(coro) -> Optional[str]:
+    """
+    Имя полезной корутины задачи. Application.create_task заворачивает всё в
+    __create_task_callback(coroutine=...), поэтому разворачиваем до исходной.
+    None — для handle_update: такие хендлеры уже засекает _timed_callback.
+    """
+    for _ in range(3):
+        frame = getattr(coro, "cr_frame", None)  # у ещё не запущенной корутины тут её аргументы
+        inner = frame.f_locals.get("coroutine") if frame is not None else None
+        if inner is None:
+            break
+        coro = inner
+    name = getattr(coro, "__qualname__", type(coro).__name__)
+    if name.endswith(".handle_update"):
+        return None
+    return name
+
+def _timing_task_factory(prev_factory, durations: List[Tuple[float, str]]):
+    """Фабрика задач, засекающая полное время жизни каждой корутины."""
+    def factory(loop, coro, **kwargs):
+        name = _task_coro_name(coro)
+        if prev_factory is not None:
+            task = prev_factory(loop, coro, **kwargs)
+        else:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+        if name is None:
+            return task
+        started = loop.time()
+        task.add_done_callback(lambda _t: durations.append((loop.time() - started, name)))
+        return task
+    return factory
+
+def _timed_callback(callback, durations: List[Tuple[float, str]]):
+    """
+    Обёртка хендлера на время профилирования. При max_concurrent_updates == 1 PTB
+    обрабатывает апдейты без отдельных задач, так что фабрика задач их не видит.
+    """
+    async def wrapper(update, context):
+        t0 = time.monotonic()
+        try:
+            return await callback(update, context)
+        finally:
+            durations.append((time.monotonic() - t0, callback.__qualname__))
+    return wrapper
+
+# Лист стека, означающий, что цикл простаивает в ожидании I/O
+IDLE_FRAME = "selectors.py:select"
+
+def profile_report(seconds: float, stacks: Counter, samples: int, lags: List[float],
+                   durations: List[Tuple[float, str]], top: int = 25) -> str:
+    total = sum(stacks.values())
+    idle = sum(w for stack, w in stacks.items() if stack.endswith(IDLE_FRAME))
+    busy = total - idle
+    out = [f"Профиль event loop за {seconds:.1f} с: {samples} сэмплов, "
+           f"{samples / max(seconds, 1e-9):.0f}/с (шаг {PROFILE_SAMPLE_INTERVAL * 1000:g} мс)",
+           f"занят: {busy * 1000:.0f} мс ({busy / max(total, 1e-9) * 100:.1f}%), "
+           f"простой: {idle * 1000:.0f} мс ({idle / max(total, 1e-9) * 100:.1f}%); "
+           f"сэмплы взвешены по времени, проценты ниже — от занятого", ""]
+
+    out.append("== Лаг event loop ==")
+    if lags:
+        ls = sorted(lags)
+        p95 = ls[min(len(ls) - 1, int(len(ls) * 0.95))]
+        out.append(f"замеров: {len(ls)}, среднее: {sum(ls) / len(ls) * 1000:.1f} мс, "
+                   f"p95: {p95 * 1000:.1f} мс, максимум: {ls[-1] * 1000:.1f} мс")
+    else:
+        out.append("нет данных")
+    out.append("")
+
+    self_c: Counter = Counter()
+    incl_c: Counter = Counter()
+    for stack, n in stacks.items():
+        frames = stack.split(";")
+        if frames[-1] == IDLE_FRAME:
+            continue
+        self_c[frames[-1]] += n
+        for name in set(frames):
+            incl_c[name] += n
+
+    out.append("== Топ функций (self) ==")
+    for name, n in self_c.most_common(top):
+        out.append(f"{n / busy * 100:6.2f}%  {n * 1000:8.1f} мс  {name}")
+    out.append("")
+    out.append("== Топ функций (inclusive) ==")
+    for name, n in incl_c.most_common(top):
+        out.append(f"{n / busy * 100:6.2f}%  {n * 1000:8.1f} мс  {name}")
+    out.append("")
+
+    out.append("== Самые медленные хендлеры и корутины ==")
+    agg: Dict[str, List[float]] = {}
+    for d, name in durations:
+        agg.setdefault(name, []).append(d)
+    slowest = sorted(agg.items(), key=lambda kv: max(kv[1]), reverse=True)[:top]
+    if not slowest:
+        out.append("нет завершённых вызовов")
+    for name, ds in slowest:
+        out.append(f"макс {max(ds) * 1000:8.1f} мс  сред {sum(ds) / len(ds) * 1000:8.1f} мс  "
+                   f"x{len(ds):<5d} {name}")
+    out.append("")
+
+    out.append("== Свёрнутые стеки (flamegraph.pl / speedscope), вес в мс ==")
+    for stack, w in stacks.most_common():
+        if round(w * 1000):
+            out.append(f"{stack} {round(w * 1000)}")
+    return "\n".join(out)
+
+async def profile_loop(seconds: float, app: Optional[Application] = None,
+                       finish: Optional[asyncio.Event] = None) -> str:
+    """
+    Сэмплирующий профайлер текущего event loop на окно `seconds`.
+    Стек снимается из отдельного потока, так что сам цикл почти не тормозится.
+    Если передан `app`, дополнительно засекается время каждого вызова хендлера.
+    `finish` позволяет закончить окно досрочно — отчёт строится по собранному.
+    """
+    loop = asyncio.get_running_loop()
+    stacks: Counter = Counter()
+    samples = [0]
+    lags: List[float] = []
+    durations: List[Tuple[float, str]] = []
+
+    stop = threading.Event()
+    sampler = threading.Thread(
+        target=_sample_stacks,
+        args=(threading.get_ident(), PROFILE_SAMPLE_INTERVAL, stop, stacks, samples),
+        name="loop-profiler", daemon=True)
+    lag_task = asyncio.create_task(_measure_lag(PROFILE_LAG_INTERVAL, lags))
+    prev_factory = loop.get_task_factory()
+    loop.set_task_factory(_timing_task_factory(prev_factory, durations))
+    wrapped = []
+    if app is not None:
+        for handlers in app.handlers.values():
+            for h in handlers:
+                wrapped.append((h, h.callback))
+                h.callback = _timed_callback(h.callback, durations)
+    finish = finish or asyncio.Event()
+    started = loop.time()
+    sampler.start()
+    try:
+        await asyncio.wait_for(finish.wait(), seconds)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        stop.set()
+        lag_task.cancel()
+        loop.set_task_factory(prev_factory)
+        for h, callback in wrapped:
+            h.callback = callback
+        await asyncio.to_thread(sampler.join)
+    return profile_report(loop.time() - started, stacks, samples[0], lags, list(durations))
+
+async def profile_to_file(seconds: float, path: str, app: Application,
+                          finish: asyncio.Event) -> None:
+    """Профилирование из CLI: окно отсчитывается с момента старта бота."""
+    async with profile_lock:
+        report = await profile_loop(seconds, app, finish)
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(report)
+    except OSError as e:
+        print(f"❌ Не удалось записать профиль в {path}: {e}")
+        return
+    print(f"📈 Profile written to {path}")
+
+async def cmd_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.id != MOD_GROUP_ID:
+        return
+    member = await context.bot.get_chat_member(MOD_GROUP_ID, update.effective_user.id)
+    if member.status not in (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER):
+        await update.effective_message.reply_text("Команда доступна только администраторам группы.")
+        return
+    try:
+        seconds = float(context.args[0])
+    except (IndexError, ValueError):
+        await update.effective_message.reply_text("Использование: /profile <секунды>")
+        return
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        await update.effective_message.reply_text(f"Окно должно быть от 0 до {PROFILE_MAX_SECONDS} секунд.")
+        return
+    if profile_lock.locked():
+        await update.effective_message.reply_text("Профилирование уже идёт.")
+        return
+
+    async with profile_lock:
+        await update.effective_message.reply_text(f"📈 Профилирую event loop {seconds:g} с…")
+        report = await profile_loop(seconds, context.application)
+    fname = f"profile-{dt.datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.txt"
+    await update.effective_message.reply_document(
+        document=io.BytesIO(report.encode("utf-8")), filename=fname,
+        caption=f"📈 Профиль за {seconds:g} с")
+
 # ============ MAIN ============
-async def main():
-    await init_db()
+def main(profile_seconds: Optional[float] = None, profile_out: str = "profile.txt"):
+    # post_init выполняется до start(), Application.create_task ещё не отслеживает задачи —
+    # держим ссылку сами и дожидаемся в post_stop
+    profile_finish = asyncio.Event()
+    profile_tasks: List[asyncio.Task] = []
+
+    async def post_init(application: Application) -> None:
+        await init_db()
+        if profile_seconds is not None:
+            profile_tasks.append(asyncio.create_task(
+                profile_to_file(profile_seconds, profile_out, application, profile_finish)))
+
+    async def post_stop(application: Application) -> None:
+        # бот остановлен раньше конца окна — пишем то, что успели собрать
+        profile_finish.set()
+        for task in profile_tasks:
+            try:
+                await task
+            except Exception as e:
+                print(f"❌ Профилирование завершилось ошибкой: {e!r}")
+
+    app = ApplicationBuilder().token(BOT_TOKEN).post_init(post_init).post_stop(post_stop).build()
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    # Антифлуд — раньше всех хендлеров лички
+    app.add_handler(TypeHandler(Update, admission_control), group=-1)
 
     # Пользователь
     app.add_handler(CommandHandler("start", cmd_start, filters.ChatType.PRIVATE))
@@ -701,6 +1211,19 @@ async def main():
     app.add_handler(MessageHandler(filters.Chat(MOD_GROUP_ID) & filters.TEXT, mod_group_text))
     app.add_handler(CommandHandler("history", cmd_history, filters.Chat(MOD_GROUP_ID)))
     app.add_handler(CommandHandler("stats", cmd_stats, filters.Chat(MOD_GROUP_ID)))
+    # block=False: иначе окно профилирования заблокирует обработку остальных апдейтов
+    app.add_handler(CommandHandler("profile", cmd_profile, filters.Chat(MOD_GROUP_ID), block=False))
 
     print("🤖 Bot started and polling...")
-    await app.run_polling(drop_pending_updates=True, close_loop=False)
+    app.run_polling(drop_pending_updates=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Support bot")
+    parser.add_argument("--profile", type=float, metavar="SECONDS",
+                        help="профилировать event loop первые SECONDS секунд работы (для нагрузочных прогонов)")
+    parser.add_argument("--profile-out", default="profile.txt", metavar="PATH",
+                        help="куда записать отчёт профилировщика")
+    args = parser.parse_args()
+    if args.profile is not None and args.profile <= 0:
+        parser.error("--profile: нужно положительное число секунд")
+    main(args.profile, args.profile_out)